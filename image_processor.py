@@ -1,68 +1,369 @@
 import os
 import base64
+import hashlib
+import json
+import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 from PIL import Image
 import io
 import argparse
 import sys
+import time
+import threading
+import asyncio
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from tqdm import tqdm # Import tqdm
 from pathlib import Path # Import Path
 from prompt_toolkit import prompt # Import prompt
 from prompt_toolkit.completion import PathCompleter # Import PathCompleter
 
+# Optional: libjpeg-turbo encoder, much faster than PIL's JPEG writer
+try:
+    import numpy as np
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Optional: much faster JSON serialization of the multi-MB base64 payload and response parsing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: perceptual hashing, enables reusing descriptions of near-duplicate images
+try:
+    import imagehash
+except ImportError:
+    imagehash = None
+
+# Optional: HTTP/2 client for the --http2 path (requires httpx[http2])
+try:
+    import httpx
+    import h2 # HTTP/2 support for httpx
+except ImportError:
+    httpx = None
+
+# Optional: torchvision encode pipeline, imported only when requested via --encoder
+# because importing torch adds seconds of startup time
+_torchvision = None
+_torchvision_fallback_warned = False
+
 # --- Constants ---
 DEFAULT_API_BASE_URL = "http://127.0.0.1:1234/v1"
 DEFAULT_MODEL = "llama3.1-11b-vision-instruct"
 DEFAULT_PREFIX = "IMGSCAN"
 SUPPORTED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif"}
+JPEG_QUALITY = 85
+DEFAULT_MAX_IMAGE_DIM = 1024
+MIN_TORCHVISION_VERSION = (0, 20) # decode_image() accepting paths and WebP/GIF input
+DEFAULT_CONCURRENCY = 4
+HTTP_POOL_SIZE = 32 # Keep >= the largest concurrency you expect to use
+JSON_HEADERS = {"Content-Type": "application/json"}
+_IMAGE_URL_PLACEHOLDER = "__IMAGESCAN_IMAGE_URL__" # Replaced with the data URL in the serialized body
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "imagescan" / "responses.sqlite3"
+DEFAULT_SIMILARITY_THRESHOLD = 2 # Max differing bits between 64-bit perceptual hashes
+
+# Role-play prompt for concise, underscored keywords
+VISION_PROMPT = (
+    "You are a filename generator. Describe the image using only 6 keywords maximum, "
+    "separated by underscores. Focus on the main subject. Ignore background and surface. "
+    "Example: red_mug_steam_handle_ceramic"
+)
+# Part of the cache key, so editing the prompt invalidates cached responses
+_PROMPT_HASH = hashlib.blake2b(VISION_PROMPT.encode('utf-8'), digest_size=8).hexdigest()
+
+# Single-pass character mapping for sanitize_filename: separators become
+# underscores, filesystem-invalid characters are dropped
+_FILENAME_TRANSLATION = str.maketrans(
+    {**{c: '_' for c in ',;:-'}, **{c: None for c in '<>"/\\|?*'}}
+)
+_MULTI_UNDERSCORE = re.compile(r'_+')
+
+# --- Shared State ---
+
+# One lock per target directory so concurrent workers can't pick the same new filename
+_dir_locks = {}
+_dir_locks_guard = threading.Lock()
+
+# Set on Ctrl-C so workers still finishing an API call don't go on to rename files
+_stop_requested = threading.Event()
+
+# Shared HTTP session so every API call reuses pooled keep-alive connections
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=HTTP_POOL_SIZE,
+    pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(
+        total=3,
+        read=False, # Never resend a POST after a read error/timeout; the server may still be running that job
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset(["POST"]), # Needed for the status retries above
+        raise_on_status=False # Hand the last response to raise_for_status() for normal error reporting
+    )
+)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+
+# On-disk LLM response cache, opened by open_response_cache(); None means caching is off
+_cache_conn = None
+_cache_lock = threading.Lock()
+# Near-duplicate lookup: max Hamming distance (None disables) and the in-memory
+# index of settings -> [(phash, response)], loaded from the cache on first use
+_similarity_threshold = None
+_phash_index = {}
 
 # --- Helper Functions ---
 
-def encode_image_to_base64(image_path):
-    """Encodes an image file to base64."""
+def get_dir_lock(target_dir):
+    """Returns the lock guarding renames inside target_dir, creating it on first use."""
+    with _dir_locks_guard:
+        lock = _dir_locks.get(target_dir)
+        if lock is None:
+            lock = _dir_locks[target_dir] = threading.Lock()
+        return lock
+
+def image_phash(img):
+    """Returns the 64-bit perceptual hash of a PIL image as an int."""
+    return int(str(imagehash.phash(img)), 16)
+
+def enable_torchvision_encoder():
+    """Switches re-encoding to the torchvision pipeline. Raises ImportError if torchvision
+    is not installed or is older than MIN_TORCHVISION_VERSION."""
+    global _torchvision
+    import torchvision
+    import torchvision.io
+    import torchvision.transforms.functional
+    version = re.match(r'(\d+)\.(\d+)', torchvision.__version__)
+    if not version or tuple(map(int, version.groups())) < MIN_TORCHVISION_VERSION:
+        required = '.'.join(map(str, MIN_TORCHVISION_VERSION))
+        raise ImportError(f"torchvision {torchvision.__version__} is installed, but {required} or newer is required")
+    _torchvision = (torchvision.io, torchvision.transforms.functional)
+
+def encode_with_torchvision(image_path, max_image_dim, with_phash):
+    """Decodes, resizes and JPEG-encodes an image as one uint8 tensor pipeline, without
+    PIL or BytesIO intermediates. Returns (base64_image, phash), or None if torchvision
+    can't decode the file so the caller can fall back to PIL."""
+    global _torchvision_fallback_warned
+    tv_io, tv_functional = _torchvision
     try:
-        with Image.open(image_path) as img:
+        tensor = tv_io.decode_image(str(image_path), mode=tv_io.ImageReadMode.RGB)
+    except (RuntimeError, ValueError) as e: # torchvision's decode errors
+        if not _torchvision_fallback_warned:
+            _torchvision_fallback_warned = True
+            tqdm.write(f"Warning: torchvision could not decode {image_path} ({e}); using PIL for files it can't handle.", file=sys.stderr)
+        return None
+    if tensor.ndim == 4: # Animated GIF: keep the first frame, like PIL
+        tensor = tensor[0]
+    height, width = tensor.shape[-2:]
+    if max_image_dim and max(height, width) > max_image_dim:
+        scale = max_image_dim / max(height, width)
+        new_size = [max(1, round(height * scale)), max(1, round(width * scale))]
+        tensor = tv_functional.resize(tensor, new_size, antialias=True)
+    jpeg_tensor = tv_io.encode_jpeg(tensor, quality=JPEG_QUALITY)
+    phash = image_phash(Image.fromarray(tensor.permute(1, 2, 0).numpy())) if with_phash else None
+    return base64.b64encode(jpeg_tensor.numpy().tobytes()), phash
+
+def encode_image_to_base64(image_path, max_image_dim=DEFAULT_MAX_IMAGE_DIM, with_phash=False):
+    """Encodes an image file to base64 JPEG data, downscaling it to fit max_image_dim.
+
+    Returns (base64_image, phash), or (None, None) on error. base64_image is ASCII bytes,
+    kept as bytes so it can be spliced into the request body without copies. phash is only computed
+    when with_phash is set, reusing the image decoded for encoding; otherwise it is None.
+    """
+    try:
+        with Image.open(image_path) as img: # Only reads the header until pixels are needed
+            # Go by the decoded header, not the suffix: a mislabelled PNG/WebP must
+            # not be sent as image/jpeg
+            is_jpeg = img.format == 'JPEG'
+            needs_resize = bool(max_image_dim) and max(img.size) > max_image_dim
+
+            # RGB/grayscale JPEGs that are already small enough are sent as-is
+            # instead of paying for a decode + lossy re-encode; CMYK and other
+            # modes still go through the RGB conversion below
+            if is_jpeg and img.mode in ('RGB', 'L') and not needs_resize:
+                with open(image_path, 'rb') as f:
+                    base64_image = base64.b64encode(f.read())
+                phash = None
+                if with_phash:
+                    # phash works on a 32x32 grayscale thumbnail, so a reduced-scale decode is enough
+                    img.draft('L', (128, 128))
+                    phash = image_phash(img)
+                return base64_image, phash
+
+            if _torchvision is not None:
+                encoded = encode_with_torchvision(image_path, max_image_dim, with_phash)
+                if encoded is not None:
+                    return encoded
+
+            if is_jpeg and needs_resize:
+                # Let libjpeg decode at a reduced scale; thumbnail() finishes the resize
+                img.draft('RGB', (max_image_dim, max_image_dim))
             if img.mode != 'RGB':
                 img = img.convert('RGB')
-            buffered = io.BytesIO()
-            img.save(buffered, format="JPEG")
-            img_byte = buffered.getvalue()
-            return base64.b64encode(img_byte).decode('utf-8')
+            if needs_resize:
+                # Vision models downscale internally anyway, so don't encode or upload extra pixels
+                img.thumbnail((max_image_dim, max_image_dim), Image.Resampling.LANCZOS)
+            if simplejpeg is not None:
+                img_byte = simplejpeg.encode_jpeg(np.asarray(img), quality=JPEG_QUALITY, colorspace='RGB', fastdct=True)
+            else:
+                buffered = io.BytesIO()
+                img.save(buffered, format="JPEG", quality=JPEG_QUALITY)
+                img_byte = buffered.getvalue()
+            phash = image_phash(img) if with_phash else None
+            return base64.b64encode(img_byte), phash
     except Exception as e:
         tqdm.write(f"Error encoding image {image_path}: {e}", file=sys.stderr) # Use tqdm.write for progress bar compatibility
-        return None
+        return None, None
 
 def sanitize_filename(text):
     """Removes or replaces characters that are invalid in filenames, keeping underscores."""
-    # Replace common problematic separators potentially returned by LLM with underscores
-    text = re.sub(r'[\s,;:-]+', '_', text)
-    # Remove characters invalid in most filesystems
-    text = re.sub(r'[<>:"/\\|?*]', '', text)
+    # Replace whitespace runs and common problematic separators potentially
+    # returned by LLM with underscores, and drop characters invalid in most filesystems
+    text = '_'.join(text.split()).translate(_FILENAME_TRANSLATION)
     # Consolidate multiple underscores
-    text = re.sub(r'_+', '_', text)
+    text = _MULTI_UNDERSCORE.sub('_', text)
     # Remove leading/trailing underscores
     text = text.strip('_')
     # Limit length
     return text[:100]
 
-# --- API Interaction ---
+def dumps_json(obj):
+    """Serializes obj to UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
-def call_vision_api(image_path, api_base_url, model, temperature, max_tokens, verbose=False):
-    """Calls the LMStudio Vision API to get keyword descriptions."""
-    base64_image = encode_image_to_base64(image_path)
-    if not base64_image:
+def loads_json(data):
+    """Parses JSON from bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# --- Response Cache ---
+
+def open_response_cache(cache_path, similarity_threshold=None):
+    """Opens (creating if needed) the SQLite cache of LLM responses used by call_vision_api.
+
+    If similarity_threshold is given and imagehash is installed, images whose perceptual
+    hash is within that many bits of a cached image reuse its response.
+    """
+    global _cache_conn, _similarity_threshold
+    cache_path = Path(cache_path).expanduser()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Shared across worker threads; access is serialized with _cache_lock
+    conn = sqlite3.connect(str(cache_path), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS similar (settings TEXT NOT NULL, phash INTEGER NOT NULL, response TEXT NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS similar_settings ON similar (settings)")
+    conn.commit()
+    _cache_conn = conn
+    _similarity_threshold = similarity_threshold if imagehash is not None else None
+
+def close_response_cache():
+    """Closes the response cache if it is open."""
+    global _cache_conn, _similarity_threshold
+    with _cache_lock:
+        if _cache_conn is not None:
+            _cache_conn.close()
+            _cache_conn = None
+        _similarity_threshold = None
+        _phash_index.clear()
+
+def cache_settings(model, temperature, max_tokens, max_image_dim):
+    """Returns the part of the cache key covering everything besides the image that shapes the LLM's answer."""
+    return f"{model}|{temperature}|{max_tokens}|{max_image_dim}|{_PROMPT_HASH}"
+
+def response_cache_key(image_path, settings):
+    """Builds the exact-match cache key from the image content and the cache settings."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return f"{digest.hexdigest()}|{settings}"
+
+def cache_get(key):
+    """Returns the cached response for key, or None on a miss or if caching is off."""
+    if _cache_conn is None:
+        return None
+    try:
+        with _cache_lock:
+            row = _cache_conn.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        tqdm.write(f"  Warning: Response cache lookup failed: {e}", file=sys.stderr)
         return None
 
-    chat_completions_endpoint = f"{api_base_url}/chat/completions"
-    headers = {"Content-Type": "application/json"}
+def cache_put(key, response):
+    """Stores a response in the cache. Failures are reported but never fatal."""
+    if _cache_conn is None:
+        return
+    try:
+        with _cache_lock, _cache_conn: # Connection context manager commits the insert
+            _cache_conn.execute("INSERT OR REPLACE INTO cache (key, response) VALUES (?, ?)", (key, response))
+    except sqlite3.Error as e:
+        tqdm.write(f"  Warning: Could not store response in cache: {e}", file=sys.stderr)
+
+def similar_get(settings, phash):
+    """Returns the response cached for the most similar image within the threshold, or None."""
+    if _cache_conn is None or _similarity_threshold is None:
+        return None
+    try:
+        with _cache_lock:
+            entries = _phash_index.get(settings)
+            if entries is None:
+                rows = _cache_conn.execute("SELECT phash, response FROM similar WHERE settings = ?", (settings,))
+                # SQLite integers are signed; mask back to the unsigned 64-bit hash
+                entries = _phash_index[settings] = [(h & 0xFFFFFFFFFFFFFFFF, r) for h, r in rows]
+            best_response, best_distance = None, _similarity_threshold + 1
+            for cached_phash, response in entries:
+                distance = (cached_phash ^ phash).bit_count()
+                if distance < best_distance:
+                    best_response, best_distance = response, distance
+                    if distance == 0:
+                        break
+        return best_response
+    except sqlite3.Error as e:
+        tqdm.write(f"  Warning: Similar-image cache lookup failed: {e}", file=sys.stderr)
+        return None
+
+def similar_put(settings, phash, response):
+    """Records an image's perceptual hash and response for later near-duplicate lookups."""
+    if _cache_conn is None or _similarity_threshold is None:
+        return
+    signed_phash = phash - (1 << 64) if phash >= (1 << 63) else phash
+    try:
+        with _cache_lock, _cache_conn:
+            _cache_conn.execute("INSERT INTO similar (settings, phash, response) VALUES (?, ?, ?)", (settings, signed_phash, response))
+            entries = _phash_index.get(settings)
+            if entries is not None: # Otherwise the next lookup loads it from the table
+                entries.append((phash, response))
+    except sqlite3.Error as e:
+        tqdm.write(f"  Warning: Could not store response in similar-image cache: {e}", file=sys.stderr)
 
-    # Role-play prompt for concise, underscored keywords
-    user_message_text = (
-        "You are a filename generator. Describe the image using only 6 keywords maximum, "
-        "separated by underscores. Focus on the main subject. Ignore background and surface. "
-        "Example: red_mug_steam_handle_ceramic"
-    )
+
+# --- API Interaction ---
+
+def init_encode_worker(use_torchvision):
+    """Initializer for encode worker processes: mirrors the parent's encoder choice."""
+    if use_torchvision:
+        enable_torchvision_encoder()
+
+def build_request_body(image_path, model, temperature, max_tokens, max_image_dim, with_phash):
+    """Encodes the image and serializes the chat completion request for it.
+
+    Pure CPU work with no shared state, so it can run in an encode worker process.
+    Returns (body, phash), or (None, None) if the image could not be encoded.
+    """
+    base64_image, phash = encode_image_to_base64(image_path, max_image_dim, with_phash)
+    if not base64_image:
+        return None, None
 
     payload = {
         "model": model,
@@ -70,8 +371,8 @@ def call_vision_api(image_path, api_base_url, model, temperature, max_tokens, ve
             {
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
-                    {"type": "text", "text": user_message_text}
+                    {"type": "image_url", "image_url": {"url": _IMAGE_URL_PLACEHOLDER}},
+                    {"type": "text", "text": VISION_PROMPT}
                 ]
             }
         ],
@@ -79,29 +380,95 @@ def call_vision_api(image_path, api_base_url, model, temperature, max_tokens, ve
         "temperature": temperature
     }
 
+    # Serialize the small payload around a placeholder, then splice the data URL
+    # bytes in. Base64 never needs JSON escaping, so the multi-MB blob is copied
+    # exactly once, into the body, and no data URL string is ever built.
+    head, tail = dumps_json(payload).split(_IMAGE_URL_PLACEHOLDER.encode('ascii'), 1)
+    return b"".join((head, b"data:image/jpeg;base64,", base64_image, tail)), phash
+
+def prepare_vision_request(image_path, api_base_url, model, temperature, max_tokens, verbose=False, max_image_dim=DEFAULT_MAX_IMAGE_DIM, encode_pool=None):
+    """Does all the work before the HTTP call: cache lookups, image encoding and payload serialization.
+
+    If encode_pool (a ProcessPoolExecutor) is given, encoding runs there so it uses
+    other cores while this worker's thread only waits. Returns (description, None) when
+    a cached description can be reused, (None, request) with a request dict ready to
+    post, or (None, None) if the image could not be encoded.
+    """
+    settings = cache_settings(model, temperature, max_tokens, max_image_dim)
+    cache_key = None
+    if _cache_conn is not None:
+        try:
+            cache_key = response_cache_key(image_path, settings)
+        except OSError:
+            pass # Unreadable file; encoding below reports the error
+        else:
+            cached = cache_get(cache_key)
+            if cached:
+                if verbose:
+                    tqdm.write(f"  Cache hit for {os.path.basename(image_path)}: {cached[:100]}")
+                return cached, None
+
+    encode_args = (image_path, model, temperature, max_tokens, max_image_dim, _similarity_threshold is not None)
+    if encode_pool is not None:
+        body, phash = encode_pool.submit(build_request_body, *encode_args).result()
+    else:
+        body, phash = build_request_body(*encode_args)
+    if body is None:
+        return None, None
+
+    if phash is not None:
+        similar = similar_get(settings, phash)
+        if similar:
+            if verbose:
+                tqdm.write(f"  Similar-image cache hit for {os.path.basename(image_path)}: {similar[:100]}")
+            if cache_key:
+                cache_put(cache_key, similar) # Exact hit next time, without decoding
+            return similar, None
+
     if verbose:
          tqdm.write(f"  Calling API for {os.path.basename(image_path)} with temp={temperature}, max_tokens={max_tokens}")
 
-    try:
-        response = requests.post(chat_completions_endpoint, headers=headers, json=payload, timeout=60) # Added timeout
-        response.raise_for_status()
-        response_json = response.json()
+    return None, {
+        "endpoint": f"{api_base_url}/chat/completions",
+        "body": body,
+        "settings": settings,
+        "cache_key": cache_key,
+        "phash": phash,
+    }
 
-        if 'choices' in response_json and len(response_json['choices']) > 0:
-            message = response_json['choices'][0].get('message', {})
-            content = message.get('content')
-            if content:
-                if verbose:
-                    tqdm.write(f"  LLM Raw Response: {content.strip()[:100]}...")
-                return content.strip()
-            else:
-                tqdm.write(f"  Warning: 'content' not found in response message for {image_path}", file=sys.stderr)
-                if verbose: tqdm.write(f"  Full Response: {response_json}", file=sys.stderr)
-                return None
+def handle_vision_response(response_json, image_path, request, verbose=False):
+    """Extracts the description from a chat completion response and caches it."""
+    if 'choices' in response_json and len(response_json['choices']) > 0:
+        message = response_json['choices'][0].get('message', {})
+        content = message.get('content')
+        if content:
+            if verbose:
+                tqdm.write(f"  LLM Raw Response: {content.strip()[:100]}...")
+            if request["cache_key"]:
+                cache_put(request["cache_key"], content.strip())
+            if request["phash"] is not None:
+                similar_put(request["settings"], request["phash"], content.strip())
+            return content.strip()
         else:
-            tqdm.write(f"  Warning: 'choices' not found or empty in response for {image_path}", file=sys.stderr)
+            tqdm.write(f"  Warning: 'content' not found in response message for {image_path}", file=sys.stderr)
             if verbose: tqdm.write(f"  Full Response: {response_json}", file=sys.stderr)
             return None
+    else:
+        tqdm.write(f"  Warning: 'choices' not found or empty in response for {image_path}", file=sys.stderr)
+        if verbose: tqdm.write(f"  Full Response: {response_json}", file=sys.stderr)
+        return None
+
+def call_vision_api(image_path, api_base_url, model, temperature, max_tokens, verbose=False, max_image_dim=DEFAULT_MAX_IMAGE_DIM, encode_pool=None):
+    """Calls the LMStudio Vision API to get keyword descriptions, consulting the response cache first."""
+    description, request = prepare_vision_request(image_path, api_base_url, model, temperature, max_tokens, verbose, max_image_dim, encode_pool)
+    if request is None:
+        return description
+
+    chat_completions_endpoint = request["endpoint"]
+    try:
+        response = _SESSION.post(chat_completions_endpoint, headers=JSON_HEADERS, data=request["body"], timeout=60) # Added timeout
+        response.raise_for_status()
+        return handle_vision_response(loads_json(response.content), image_path, request, verbose)
 
     except requests.exceptions.Timeout:
         tqdm.write(f"API Error: Request timed out for {image_path} to {chat_completions_endpoint}", file=sys.stderr)
@@ -119,15 +486,82 @@ def call_vision_api(image_path, api_base_url, model, temperature, max_tokens, ve
         tqdm.write(f"Error processing API response for {image_path}: {e}", file=sys.stderr)
         return None
 
+def warm_up_model(api_base_url, model, verbose=False):
+    """Sends a tiny text-only request and waits for it, so the server loads the model
+    once before concurrent workers start instead of all of them hitting a cold start."""
+    chat_completions_endpoint = f"{api_base_url}/chat/completions"
+    payload = {"model": model, "messages": [{"role": "user", "content": "hi"}], "max_tokens": 1}
+    start = time.perf_counter()
+    try:
+        response = _SESSION.post(chat_completions_endpoint, headers=JSON_HEADERS, data=dumps_json(payload), timeout=120)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        # Not fatal: the real requests report their own errors
+        tqdm.write(f"Warning: Model warm-up request failed: {e}", file=sys.stderr)
+        return
+    if verbose:
+        tqdm.write(f"Model warm-up took {time.perf_counter() - start:.2f}s")
+
+async def call_vision_api_async(client, image_path, api_base_url, model, temperature, max_tokens, verbose=False, max_image_dim=DEFAULT_MAX_IMAGE_DIM, encode_pool=None):
+    """Async variant of call_vision_api posting through a shared httpx.AsyncClient.
+
+    Cache lookups and image encoding run in a worker thread so the event loop
+    stays free to drive the other in-flight requests.
+    """
+    description, request = await asyncio.to_thread(
+        prepare_vision_request, image_path, api_base_url, model, temperature, max_tokens, verbose, max_image_dim, encode_pool
+    )
+    if request is None:
+        return description
+
+    chat_completions_endpoint = request["endpoint"]
+    try:
+        response = await client.post(chat_completions_endpoint, headers=JSON_HEADERS, content=request["body"])
+        response.raise_for_status()
+        return handle_vision_response(loads_json(response.content), image_path, request, verbose)
+
+    except httpx.TimeoutException:
+        tqdm.write(f"API Error: Request timed out for {image_path} to {chat_completions_endpoint}", file=sys.stderr)
+        return None
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            tqdm.write(f"API Error: Endpoint {chat_completions_endpoint} not found (404). Check LM Studio server setup.", file=sys.stderr)
+        else:
+            tqdm.write(f"API HTTP Error for {image_path}: {e}", file=sys.stderr)
+        return None
+    except httpx.HTTPError as e:
+        tqdm.write(f"API Request Failed for {image_path}: {e}", file=sys.stderr)
+        return None
+    except Exception as e:
+        tqdm.write(f"Error processing API response for {image_path}: {e}", file=sys.stderr)
+        return None
+
 
 # --- File Processing ---
 
-def process_and_rename_file(filepath, target_dir, api_base_url, model, temperature, max_tokens, prefix, naming_scheme, dry_run, verbose):
+def process_and_rename_file(filepath, target_dir, api_base_url, model, temperature, max_tokens, prefix, naming_scheme, dry_run, verbose, max_image_dim=DEFAULT_MAX_IMAGE_DIM, dir_names=None, encode_pool=None):
     """Gets description from API and renames the file based on the chosen scheme."""
     if verbose:
         tqdm.write(f"Processing file: {filepath}")
 
-    description = call_vision_api(filepath, api_base_url, model, temperature, max_tokens, verbose)
+    description = call_vision_api(filepath, api_base_url, model, temperature, max_tokens, verbose, max_image_dim, encode_pool)
+    return rename_with_description(filepath, target_dir, description, prefix, naming_scheme, dry_run, verbose, dir_names)
+
+async def process_and_rename_file_async(client, filepath, target_dir, api_base_url, model, temperature, max_tokens, prefix, naming_scheme, dry_run, verbose, max_image_dim=DEFAULT_MAX_IMAGE_DIM, dir_names=None, encode_pool=None):
+    """Async variant of process_and_rename_file for the HTTP/2 path."""
+    if verbose:
+        tqdm.write(f"Processing file: {filepath}")
+
+    description = await call_vision_api_async(client, filepath, api_base_url, model, temperature, max_tokens, verbose, max_image_dim, encode_pool)
+    # Renaming may list the directory and blocks on the directory lock, so keep it off the event loop
+    return await asyncio.to_thread(rename_with_description, filepath, target_dir, description, prefix, naming_scheme, dry_run, verbose, dir_names)
+
+def rename_with_description(filepath, target_dir, description, prefix, naming_scheme, dry_run, verbose, dir_names=None):
+    """Renames the file after its LLM description based on the chosen scheme.
+
+    dir_names, if given, maps each target directory to the set of names in it and is
+    shared across calls so the directory is only listed once.
+    """
     if not description:
         tqdm.write(f"  Skipping rename for {os.path.basename(filepath)} due to missing description.", file=sys.stderr)
         return False # Indicate failure
@@ -154,51 +588,120 @@ def process_and_rename_file(filepath, target_dir, api_base_url, model, temperatu
     new_filename = f"{base_new_filename}{ext}"
     new_filepath = os.path.join(target_dir, new_filename)
 
-    # Avoid overwriting files
-    counter = 1
-    while os.path.exists(new_filepath):
-        new_filename = f"{base_new_filename}_{counter}{ext}"
-        new_filepath = os.path.join(target_dir, new_filename)
-        counter += 1
-        if counter > 100:
-             tqdm.write(f"  Error: Could not find unique filename for {original_filename} starting with '{base_new_filename}' after 100 attempts.", file=sys.stderr)
-             return False # Indicate failure
-
-    # Perform rename or dry run
-    if dry_run:
-        tqdm.write(f"[DRY RUN] Would rename '{original_filename}' to '{new_filename}'")
-        return True # Indicate success (dry run)
-    else:
-        try:
-            os.rename(filepath, new_filepath)
-            if verbose:
-                tqdm.write(f"  Renamed '{original_filename}' to '{new_filename}'")
-            return True # Indicate success
-        except OSError as e:
-            tqdm.write(f"  Error renaming file {original_filename} to {new_filename}: {e}", file=sys.stderr)
-            return False # Indicate failure
-
-def has_processed_marker(filename, prefix, naming_scheme):
-    """Checks if a filename indicates it has already been processed based on the scheme."""
+    # Pick a unique name and rename while holding the directory lock so
+    # concurrent workers can't claim the same target filename
+    with get_dir_lock(target_dir):
+        names = dir_names.get(target_dir) if dir_names is not None else None
+        if names is None:
+            try:
+                names = set(os.listdir(target_dir))
+            except OSError as e:
+                tqdm.write(f"  Error listing directory {target_dir}: {e}", file=sys.stderr)
+                return False # Indicate failure
+            if dir_names is not None:
+                dir_names[target_dir] = names
+
+        # Avoid overwriting files. Taken names are rejected from the in-memory set;
+        # a name that looks free is still stat'ed once to catch files created by
+        # other programs or matching case-insensitively.
+        counter = 1
+        while new_filename in names or os.path.exists(new_filepath):
+            names.add(new_filename)
+            new_filename = f"{base_new_filename}_{counter}{ext}"
+            new_filepath = os.path.join(target_dir, new_filename)
+            counter += 1
+            if counter > 100:
+                 tqdm.write(f"  Error: Could not find unique filename for {original_filename} starting with '{base_new_filename}' after 100 attempts.", file=sys.stderr)
+                 return False # Indicate failure
+
+        # The user asked to stop while this file's API call was in flight
+        if _stop_requested.is_set():
+            return False
+
+        # Perform rename or dry run
+        if dry_run:
+            names.add(new_filename) # Reserve it so later simulated renames don't report the same name
+            tqdm.write(f"[DRY RUN] Would rename '{original_filename}' to '{new_filename}'")
+            return True # Indicate success (dry run)
+        else:
+            try:
+                os.rename(filepath, new_filepath)
+                names.discard(original_filename)
+                names.add(new_filename)
+                if verbose:
+                    tqdm.write(f"  Renamed '{original_filename}' to '{new_filename}'")
+                return True # Indicate success
+            except OSError as e:
+                tqdm.write(f"  Error renaming file {original_filename} to {new_filename}: {e}", file=sys.stderr)
+                return False # Indicate failure
+
+def make_processed_checker(prefix, naming_scheme):
+    """Returns a function telling whether a filename has already been processed based
+    on the scheme. The markers are built once, not per file, and since they end in an
+    underscore they can't match across the extension, so no splitext is needed."""
     if not prefix: # If no prefix is used, skipping isn't really possible based on prefix
-        return False
-        
-    name, _ = os.path.splitext(filename)
-    marker = f"_{prefix}_" # Used in original_prefix_desc
+        return lambda name: False
 
     if naming_scheme == 'original_prefix_desc':
-        # Check if _{prefix}_ exists somewhere in the name part
-        return marker in name
+        # Check if _{prefix}_ exists somewhere in the name
+        marker = f"_{prefix}_"
+        return lambda name: marker in name
     elif naming_scheme == 'prefix_desc':
         # Check if the filename starts with the prefix and an underscore
-        return name.startswith(f"{prefix}_")
-    elif naming_scheme == 'desc_only':
-        # Cannot reliably determine if 'desc_only' has been processed
-        return False
-    return False
+        prefix_start = f"{prefix}_"
+        return lambda name: name.startswith(prefix_start)
+    # Cannot reliably determine if 'desc_only' has been processed
+    return lambda name: False
 
 
-def process_directory(directory_path, api_base_url, model, temperature, max_tokens, prefix, naming_scheme, skip_processed, dry_run, verbose):
+def iter_files(directory_path):
+    """Recursively yields (directory, DirEntry) for every file, skipping hidden directories."""
+    try:
+        with os.scandir(directory_path) as entries:
+            subdirs = []
+            for entry in entries:
+                # DirEntry caches the file type from the directory listing, so no extra stat
+                if entry.is_dir(follow_symlinks=False):
+                    # Skip hidden directories (like .venv, .git)
+                    if not entry.name.startswith('.'):
+                        subdirs.append(entry.path)
+                elif entry.is_file():
+                    yield directory_path, entry
+    except OSError:
+        return # Skip unreadable directories, as os.walk does
+    for subdir in subdirs:
+        yield from iter_files(subdir)
+
+
+async def process_files_async(files_to_process, api_base_url, model, temperature, max_tokens, prefix, naming_scheme, dry_run, verbose, max_image_dim, dir_names, concurrency, record_result, encode_pool=None):
+    """Processes files with up to `concurrency` requests multiplexed over a shared HTTP/2 client.
+
+    record_result(success) is called as each file finishes.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+        retries=3 # Connection failures only; httpx does not retry on status codes
+    )
+    async with httpx.AsyncClient(transport=transport, timeout=60.0) as client:
+        async def process_one(filepath, root_dir):
+            async with semaphore:
+                try:
+                    success = await process_and_rename_file_async(
+                        client, filepath, root_dir, api_base_url, model, temperature, max_tokens,
+                        prefix, naming_scheme, dry_run, verbose, max_image_dim, dir_names, encode_pool
+                    )
+                except Exception as e:
+                     # Catch unexpected errors during the processing of a single file
+                     tqdm.write(f"!! Unhandled error processing file {filepath}: {e}", file=sys.stderr)
+                     success = False
+                record_result(success)
+
+        await asyncio.gather(*(process_one(filepath, root_dir) for filepath, root_dir in files_to_process))
+
+
+def process_directory(directory_path, api_base_url, model, temperature, max_tokens, prefix, naming_scheme, skip_processed, dry_run, verbose, concurrency=DEFAULT_CONCURRENCY, max_image_dim=DEFAULT_MAX_IMAGE_DIM, http2=False, warmup=True, encode_workers=0):
     """Walks through a directory and processes all supported image files."""
     
     # --- Collect files first ---
@@ -207,27 +710,29 @@ def process_directory(directory_path, api_base_url, model, temperature, max_toke
     files_skipped_hidden = 0
     files_skipped_processed = 0
 
+    is_processed = make_processed_checker(prefix, naming_scheme)
+
     if verbose: print("Scanning directories to collect image files...")
-    for root, dirs, files in os.walk(directory_path):
-         # Skip hidden directories (like .venv, .git)
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-        
-        for filename in files:
-            if filename.startswith('.'):
-                files_skipped_hidden += 1
-                continue
-
-            _, ext = os.path.splitext(filename)
-            if ext.lower() not in SUPPORTED_EXTENSIONS:
-                files_skipped_type += 1
-                continue
-
-            if skip_processed and has_processed_marker(filename, prefix, naming_scheme):
-                 if verbose: tqdm.write(f"  Skipping already processed file: {os.path.join(root, filename)}")
-                 files_skipped_processed += 1
-                 continue
-
-            files_to_process.append((os.path.join(root, filename), root))
+    for root, entry in iter_files(directory_path):
+        filename = entry.name
+        if filename.startswith('.'):
+            files_skipped_hidden += 1
+            continue
+
+        # Cheapest filter first: on re-runs most files are already processed,
+        # and the marker check works on the raw filename
+        if skip_processed and is_processed(filename):
+             if verbose: tqdm.write(f"  Skipping already processed file: {entry.path}")
+             files_skipped_processed += 1
+             continue
+
+        dot = filename.rfind('.')
+        ext = filename[dot:].lower() if dot >= 0 else ''
+        if ext not in SUPPORTED_EXTENSIONS:
+            files_skipped_type += 1
+            continue
+
+        files_to_process.append((entry.path, root))
 
     total_files = len(files_to_process)
     if total_files == 0:
@@ -243,29 +748,82 @@ def process_directory(directory_path, api_base_url, model, temperature, max_toke
     # --- Process files with progress bar ---
     processed_success_count = 0
     processed_fail_count = 0
+    interrupted = False
+
+    dir_names = {} # Lazily filled listing of each target directory, shared by all workers
+
+    if warmup:
+        if verbose: print("Warming up model...")
+        warm_up_model(api_base_url, model, verbose)
+
+    # Optional second pipeline stage: network workers hand the CPU-bound encode to
+    # separate processes, so encoding one image overlaps other images' network waits.
+    # Each worker waits on its own encode, which bounds in-flight bodies to `concurrency`.
+    encode_pool = None
+    if encode_workers:
+        encode_pool = ProcessPoolExecutor(
+            max_workers=encode_workers,
+            mp_context=multiprocessing.get_context("spawn"), # Forking a process with live threads is unsafe
+            initializer=init_encode_worker,
+            initargs=(_torchvision is not None,)
+        )
+
+    print(f"Starting processing... (Dry Run: {dry_run}, Concurrency: {concurrency}, Encode Workers: {encode_workers or 'inline'})")
+    with encode_pool if encode_pool is not None else contextlib.nullcontext(), \
+         tqdm(total=total_files, unit="file", desc="Processing Images",
+              # Batch redraws during bursts of completions: at most twice a second
+              mininterval=0.5, smoothing=0.1) as pbar:
+        def record_result(success):
+            nonlocal processed_success_count, processed_fail_count
+            if success:
+                processed_success_count += 1
+            else:
+                processed_fail_count += 1
+            pbar.update(1) # Update progress bar regardless of success/failure
 
-    print(f"Starting processing... (Dry Run: {dry_run})")
-    with tqdm(total=total_files, unit="file", desc="Processing Images") as pbar:
-        for filepath, root_dir in files_to_process:
+        if http2:
             try:
-                success = process_and_rename_file(
+                asyncio.run(process_files_async(
+                    files_to_process, api_base_url, model, temperature, max_tokens,
+                    prefix, naming_scheme, dry_run, verbose, max_image_dim, dir_names, concurrency, record_result, encode_pool
+                ))
+            except KeyboardInterrupt:
+                interrupted = True
+                _stop_requested.set()
+        else:
+            # API calls are I/O-bound, so a thread pool overlaps the waits on the server
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+            futures = {
+                executor.submit(
+                    process_and_rename_file,
                     filepath, root_dir, api_base_url, model, temperature, max_tokens,
-                    prefix, naming_scheme, dry_run, verbose
-                )
-                if success:
-                    processed_success_count += 1
-                else:
-                    processed_fail_count += 1
-            except Exception as e:
-                 # Catch unexpected errors during the processing of a single file
-                 tqdm.write(f"!! Unhandled error processing file {filepath}: {e}", file=sys.stderr)
-                 processed_fail_count += 1
+                    prefix, naming_scheme, dry_run, verbose, max_image_dim, dir_names, encode_pool
+                ): filepath
+                for filepath, root_dir in files_to_process
+            }
+            try:
+                for future in as_completed(futures):
+                    try:
+                        record_result(future.result())
+                    except Exception as e:
+                         # Catch unexpected errors during the processing of a single file
+                         tqdm.write(f"!! Unhandled error processing file {futures[future]}: {e}", file=sys.stderr)
+                         record_result(False)
+            except KeyboardInterrupt:
+                interrupted = True
+                _stop_requested.set()
             finally:
-                 pbar.update(1) # Update progress bar regardless of success/failure
+                # On Ctrl-C drop the queued files instead of working through all of them
+                executor.shutdown(wait=not interrupted, cancel_futures=interrupted)
+
+        if interrupted and encode_pool is not None:
+            encode_pool.shutdown(wait=False, cancel_futures=True)
 
     # --- Final Summary ---
     print() # Print newline separately
     print("--- Processing Summary ---")
+    if interrupted:
+         print(f"Interrupted by user. {total_files - processed_success_count - processed_fail_count} files were left untouched.")
     if dry_run:
          print(f"Dry run complete. Would have attempted to process {total_files} files.")
          print(f"  Simulated Successes: {processed_success_count}")
@@ -275,6 +833,9 @@ def process_directory(directory_path, api_base_url, model, temperature, max_toke
         print(f"Failed to process {processed_fail_count} files (API errors, bad descriptions, rename errors, etc.).")
     print("--------------------------")
 
+    if interrupted:
+        raise KeyboardInterrupt
+
 
 # --- Main Execution ---
 
@@ -298,6 +859,26 @@ if __name__ == "__main__":
                         help="LLM temperature (creativity). Lower is more focused.")
     parser.add_argument("--max-tokens", type=int, default=50,
                         help="Max tokens for LLM response. Keep low for keywords.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Number of images to process in parallel. Bounded in practice by the API server.")
+    parser.add_argument("--encode-workers", type=int, default=0,
+                        help="Encode images in this many separate processes so CPU-bound encoding overlaps network waits (e.g. half your CPU cores). 0 encodes inside the network workers.")
+    parser.add_argument("--warmup", action=argparse.BooleanOptionalAction, default=True,
+                        help="Send a tiny request first so the model is loaded before concurrent processing starts.")
+    parser.add_argument("--http2", action="store_true",
+                        help="Send requests concurrently over a multiplexed HTTP/2 connection using asyncio (requires httpx[http2]). HTTP/2 is negotiated on https:// endpoints; plain http:// uses pooled HTTP/1.1 connections.")
+    parser.add_argument("--max-image-dim", type=int, default=DEFAULT_MAX_IMAGE_DIM,
+                        help="Downscale images so their longest side is at most this many pixels before sending. Set to 0 to send full resolution.")
+    parser.add_argument("--encoder", choices=['pil', 'torchvision'], default='pil',
+                        help="Pipeline used to decode, resize and re-encode images: 'pil' (uses simplejpeg if installed) or 'torchvision' (requires torchvision 0.20 or newer).")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=True,
+                        help="Reuse LLM responses cached from earlier runs for identical images and settings.")
+    parser.add_argument("--cache-path", default=str(DEFAULT_CACHE_PATH),
+                        help="SQLite file used for the response cache.")
+    parser.add_argument("--reuse-similar", action=argparse.BooleanOptionalAction, default=False,
+                        help="Reuse the cached response of a visually near-identical image (bursts, re-exports). Perceptual hashes compare grayscale structure only and ignore color, so images differing mainly in color share one description. Requires the cache and the optional imagehash package.")
+    parser.add_argument("--similarity-threshold", type=int, default=DEFAULT_SIMILARITY_THRESHOLD,
+                        help="Max number of differing bits (out of 64) between perceptual hashes for --reuse-similar.")
 
     # Renaming Configuration
     parser.add_argument("--prefix", default=DEFAULT_PREFIX,
@@ -365,6 +946,39 @@ if __name__ == "__main__":
          print("Warning: Cannot reliably skip processed files with 'desc_only' naming scheme. Disabling skip.", file=sys.stderr)
          args.skip_processed = False
 
+    if args.concurrency < 1:
+         print(f"Error: --concurrency must be at least 1 (got {args.concurrency}).", file=sys.stderr)
+         sys.exit(1)
+
+    if args.similarity_threshold < 0:
+         print(f"Error: --similarity-threshold cannot be negative (got {args.similarity_threshold}).", file=sys.stderr)
+         sys.exit(1)
+
+    if args.reuse_similar and args.cache and imagehash is None:
+         print("Warning: imagehash is not installed; --reuse-similar has no effect.", file=sys.stderr)
+
+    if args.encoder == 'torchvision':
+        try:
+            enable_torchvision_encoder()
+        except ImportError as e:
+            print(f"Error: --encoder torchvision requires torchvision 0.20 or newer ({e}).", file=sys.stderr)
+            sys.exit(1)
+
+    if args.http2 and httpx is None:
+         print("Error: --http2 requires httpx with HTTP/2 support (pip install 'httpx[http2]').", file=sys.stderr)
+         sys.exit(1)
+
+    if args.concurrency > HTTP_POOL_SIZE:
+         print(f"Warning: --concurrency {args.concurrency} exceeds the HTTP connection pool size ({HTTP_POOL_SIZE}). Extra workers will open short-lived connections.", file=sys.stderr)
+
+    if args.encode_workers < 0:
+         print(f"Error: --encode-workers cannot be negative (got {args.encode_workers}).", file=sys.stderr)
+         sys.exit(1)
+
+    if args.max_image_dim < 0:
+         print(f"Error: --max-image-dim cannot be negative (got {args.max_image_dim}).", file=sys.stderr)
+         sys.exit(1)
+
     if not args.skip_processed:
         print("Warning: Running without skipping processed files (`--no-skip-processed`). Files may be processed multiple times.", file=sys.stderr)
 
@@ -374,8 +988,10 @@ if __name__ == "__main__":
         print(f"  Target Directory: {args.target_directory}")
         print(f"  API URL:          {args.api_base_url}")
         print(f"  Model:            {args.model}")
+        print(f"  Concurrency:      {args.concurrency}{' (HTTP/2)' if args.http2 else ''}")
         print(f"  Naming Scheme:    {args.naming_scheme} (Prefix: '{args.prefix}')")
         print(f"  Skip Processed:   {args.skip_processed}")
+        print(f"  Response Cache:   {args.cache_path if args.cache else 'disabled'}")
         print(f"  Dry Run:          {args.dry_run}")
         print("----------------------")
         try:
@@ -390,18 +1006,35 @@ if __name__ == "__main__":
              print("\nOperation cancelled by user.", file=sys.stderr)
              sys.exit(1)
 
+    # --- Open Response Cache --- 
+    if args.cache:
+        try:
+            open_response_cache(args.cache_path, args.similarity_threshold if args.reuse_similar else None)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Warning: Could not open response cache at {args.cache_path}: {e}. Continuing without cache.", file=sys.stderr)
+
     # --- Call the main processing function --- 
-    process_directory(
-        directory_path=args.target_directory,
-        api_base_url=args.api_base_url,
-        model=args.model,
-        temperature=args.temperature,
-        max_tokens=args.max_tokens,
-        prefix=args.prefix,
-        naming_scheme=args.naming_scheme,
-        skip_processed=args.skip_processed,
-        dry_run=args.dry_run,
-        verbose=args.verbose
-    )
+    try:
+        process_directory(
+            directory_path=args.target_directory,
+            api_base_url=args.api_base_url,
+            model=args.model,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            prefix=args.prefix,
+            naming_scheme=args.naming_scheme,
+            skip_processed=args.skip_processed,
+            dry_run=args.dry_run,
+            verbose=args.verbose,
+            concurrency=args.concurrency,
+            max_image_dim=args.max_image_dim,
+            http2=args.http2,
+            warmup=args.warmup,
+            encode_workers=args.encode_workers
+        )
+    except KeyboardInterrupt: # Handle Ctrl+C
+        print("\nOperation cancelled by user.", file=sys.stderr)
+        sys.exit(1)
+    close_response_cache()
 
     print("Image processing complete.") 
\ No newline at end of file